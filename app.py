@@ -1,12 +1,19 @@
 import os
 import re
 import csv
+import time
+import socket
+import hashlib
 import sqlite3
+import threading
+import multiprocessing
 from io import BytesIO
 from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from flask import (
-    Flask, g, render_template, request, abort, redirect, session, send_file
+    Flask, g, render_template, request, abort, redirect, session, send_file, jsonify
 )
 
 from reportlab.pdfgen import canvas
@@ -23,6 +30,14 @@ DB_PATH = os.path.join(APP_DIR, "test.db")
 ADMIN_PASSWORD = "Rotamotion1"
 ADMIN_BASE = "/controlpanel"
 
+# Async certificates: render PDFs in a small process pool instead of the request thread
+CERT_ASYNC = os.environ.get("CERT_ASYNC", "") == "1"
+CERT_WORKERS = max(1, int(os.environ.get("CERT_WORKERS", "2")))
+CERT_DIR = os.environ.get("CERT_DIR", os.path.join(APP_DIR, "certificates"))
+CERT_PENDING_TIMEOUT = int(os.environ.get("CERT_PENDING_TIMEOUT", "30"))  # seconds before a claim is stale
+CERT_FAILED_TTL = int(os.environ.get("CERT_FAILED_TTL", "60"))  # seconds a failure is reported before auto-retry
+CERT_TTL = int(os.environ.get("CERT_TTL", str(7 * 24 * 3600)))  # seconds a rendered PDF is kept in CERT_DIR
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "change-me-in-render-env")
 
@@ -282,6 +297,297 @@ def make_certificate_pdf(student_name: str, test_title: str, date_str: str) -> B
     return buf
 
 
+def certificate_filename(student_name: str, slug: str) -> str:
+    safe_name = re.sub(r"[^a-zA-Z0-9_-]+", "_", student_name).strip("_") or "student"
+    return f"Certificate_{safe_name}_{slug}.pdf"
+
+
+def render_certificate_file(path: str, student_name: str, test_title: str, date_str: str) -> float:
+    # Runs inside a pool worker process; returns render time in seconds
+    started = time.perf_counter()
+    pdf = make_certificate_pdf(student_name, test_title, date_str)
+
+    # Write to a temp file first so readers never see a half-written PDF
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pdf.getvalue())
+    os.replace(tmp_path, path)
+
+    return time.perf_counter() - started
+
+
+# -----------------------------
+# Certificate job queue (CERT_ASYNC=1)
+# -----------------------------
+# Job state is shared between gunicorn workers through files in CERT_DIR:
+#   <key>.pdf      finished certificate; pruned after CERT_TTL seconds
+#   <key>.pending  render claimed by "<host>:<pid>" (created with O_EXCL)
+#   <key>.failed   last render failed; kept for CERT_FAILED_TTL seconds
+# CERT_DIR is a disposable cache: deleting it only means certificates are
+# rendered again on the next request. Counters in _cert_stats are per worker.
+_cert_lock = threading.Lock()
+_cert_executor = None
+_cert_executor_pid = None
+_cert_stats = {
+    "submitted": 0,
+    "deduplicated": 0,
+    "completed": 0,
+    "failed": 0,
+    "render_seconds_total": 0.0,
+    "render_seconds_last": None,
+    "render_seconds_max": 0.0,
+    "wait_seconds_last": None,
+}
+
+
+def _cert_pool(reset: bool = False) -> ProcessPoolExecutor:
+    # Created lazily so each gunicorn worker gets its own pool after forking
+    global _cert_executor, _cert_executor_pid
+    if reset or _cert_executor is None or _cert_executor_pid != os.getpid():
+        if _cert_executor is not None and _cert_executor_pid == os.getpid():
+            _cert_executor.shutdown(wait=False, cancel_futures=True)
+        _cert_executor = ProcessPoolExecutor(
+            max_workers=CERT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        _cert_executor_pid = os.getpid()
+    return _cert_executor
+
+
+def certificate_key(attempt, test) -> str:
+    # Tie the cached file to the attempt row, not just its id: ids restart at 1
+    # when test.db is recreated, while CERT_DIR may still hold old certificates.
+    ident = f"{attempt['id']}|{attempt['created_at']}|{attempt['student_name']}|{test['title']}"
+    digest = hashlib.sha256(ident.encode("utf-8")).hexdigest()[:16]
+    return f"attempt_{attempt['id']}_{digest}"
+
+
+def certificate_path(key: str) -> str:
+    return os.path.join(CERT_DIR, f"{key}.pdf")
+
+
+def _marker_path(key: str, kind: str) -> str:
+    return os.path.join(CERT_DIR, f"{key}.{kind}")
+
+
+def _marker_age(path: str):
+    try:
+        return time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _pending_is_live(path: str) -> bool:
+    # A claim is live until it times out or its owning worker is gone
+    age = _marker_age(path)
+    if age is None or age > CERT_PENDING_TIMEOUT:
+        return False
+
+    try:
+        with open(path) as f:
+            host, _, pid = f.read().strip().rpartition(":")
+    except FileNotFoundError:
+        return False
+
+    # Owner can only be checked from the same host (CERT_DIR may be shared)
+    if host == socket.gethostname() and pid.isdigit():
+        return _pid_alive(int(pid))
+    return True
+
+
+def _claim_pending(key: str) -> bool:
+    path = _marker_path(key, "pending")
+    if os.path.exists(path) and not _pending_is_live(path):
+        # The worker that claimed this render died mid-job
+        _remove_file(path)
+
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{socket.gethostname()}:{os.getpid()}")
+    return True
+
+
+def _mark_failed(key: str):
+    try:
+        with open(_marker_path(key, "failed"), "w") as f:
+            f.write(now_utc_iso())
+        _remove_file(_marker_path(key, "pending"))
+    except OSError:
+        app.logger.exception("Could not record failed certificate render for %s", key)
+
+
+def _prune_certificates():
+    # Drop expired PDFs and failure markers, plus claims whose owner is gone
+    now = time.time()
+    try:
+        names = os.listdir(CERT_DIR)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        path = os.path.join(CERT_DIR, name)
+        try:
+            if name.endswith(".pending"):
+                if not _pending_is_live(path):
+                    os.remove(path)
+                continue
+            if name.endswith(".pdf"):
+                ttl = CERT_TTL
+            elif name.endswith(".failed"):
+                ttl = CERT_FAILED_TTL
+            else:
+                continue
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _on_certificate_done(key: str, queued_at: float, future):
+    try:
+        elapsed = future.result()
+    except Exception:
+        app.logger.exception("Certificate render failed for %s", key)
+        with _cert_lock:
+            _cert_stats["failed"] += 1
+        _mark_failed(key)
+        return
+
+    with _cert_lock:
+        _cert_stats["completed"] += 1
+        _cert_stats["render_seconds_total"] += elapsed
+        _cert_stats["render_seconds_last"] = elapsed
+        _cert_stats["render_seconds_max"] = max(_cert_stats["render_seconds_max"], elapsed)
+        # Time spent queued, excluding the render itself
+        _cert_stats["wait_seconds_last"] = max(0.0, time.time() - queued_at - elapsed)
+
+    try:
+        _remove_file(_marker_path(key, "pending"))
+        _prune_certificates()
+    except OSError:
+        app.logger.exception("Could not clean up after certificate render for %s", key)
+
+
+def certificate_job_status(key: str):
+    # "ready", "pending", "failed", or None when no worker knows about the job
+    if os.path.exists(certificate_path(key)):
+        return "ready"
+
+    if _pending_is_live(_marker_path(key, "pending")):
+        return "pending"
+
+    age = _marker_age(_marker_path(key, "failed"))
+    if age is not None:
+        if age <= CERT_FAILED_TTL:
+            return "failed"
+        _remove_file(_marker_path(key, "failed"))
+
+    return None
+
+
+def enqueue_certificate(key: str, student_name: str, test_title: str, retry: bool = False) -> str:
+    # Returns the job status; concurrent calls for the same attempt, from any
+    # worker, share one render. A recent failure is only retried when asked.
+    status = certificate_job_status(key)
+    if status == "pending":
+        with _cert_lock:
+            _cert_stats["deduplicated"] += 1
+    if status in ("ready", "pending") or (status == "failed" and not retry):
+        return status
+
+    os.makedirs(CERT_DIR, exist_ok=True)
+    if not _claim_pending(key):
+        with _cert_lock:
+            _cert_stats["deduplicated"] += 1
+        return "pending"
+
+    # Another worker may have finished between the status check and our claim
+    if os.path.exists(certificate_path(key)):
+        _remove_file(_marker_path(key, "pending"))
+        return "ready"
+    _remove_file(_marker_path(key, "failed"))
+
+    date_str = datetime.now().strftime("%m/%d/%Y")
+    job_args = (render_certificate_file, certificate_path(key), student_name, test_title, date_str)
+    queued_at = time.time()
+    with _cert_lock:
+        try:
+            try:
+                future = _cert_pool().submit(*job_args)
+            except BrokenProcessPool:
+                # A render worker died (e.g. OOM); start a fresh pool and try once more
+                future = _cert_pool(reset=True).submit(*job_args)
+        except Exception:
+            app.logger.exception("Could not queue certificate render for %s", key)
+            _cert_stats["failed"] += 1
+            future = None
+        else:
+            _cert_stats["submitted"] += 1
+
+    if future is None:
+        _mark_failed(key)
+        return "failed"
+
+    future.add_done_callback(lambda f: _on_certificate_done(key, queued_at, f))
+    return "pending"
+
+
+def certificate_queue_depth() -> int:
+    # Live claims across all workers sharing CERT_DIR
+    try:
+        names = os.listdir(CERT_DIR)
+    except FileNotFoundError:
+        return 0
+    return sum(
+        1 for name in names
+        if name.endswith(".pending") and _pending_is_live(os.path.join(CERT_DIR, name))
+    )
+
+
+def certificate_metrics() -> dict:
+    queue_depth = certificate_queue_depth()
+    with _cert_lock:
+        completed = _cert_stats["completed"]
+        avg = (_cert_stats["render_seconds_total"] / completed) if completed else None
+        return {
+            "async_enabled": CERT_ASYNC,
+            "pool_size": CERT_WORKERS,
+            "queue_depth": queue_depth,
+            # Counters below only cover the gunicorn worker answering this request
+            "this_worker": {
+                "pid": os.getpid(),
+                "submitted": _cert_stats["submitted"],
+                "deduplicated": _cert_stats["deduplicated"],
+                "completed": completed,
+                "failed": _cert_stats["failed"],
+                "render_seconds_avg": avg,
+                "render_seconds_last": _cert_stats["render_seconds_last"],
+                "render_seconds_max": _cert_stats["render_seconds_max"],
+                "wait_seconds_last": _cert_stats["wait_seconds_last"],
+            },
+        }
+
+
 # -----------------------------
 # Student routes
 # -----------------------------
@@ -371,12 +677,12 @@ def submit_test(slug):
         score=score,
         passed=bool(passed),
         review=review,
-        attempt_id=attempt_id
+        attempt_id=attempt_id,
+        cert_async=CERT_ASYNC
     )
 
 
-@app.get("/tests/<slug>/certificate/<int:attempt_id>")
-def certificate(slug, attempt_id: int):
+def _passed_attempt(slug, attempt_id: int):
     t = db().execute("SELECT * FROM tests WHERE slug=?", (slug,)).fetchone()
     if not t:
         abort(404)
@@ -392,16 +698,58 @@ def certificate(slug, attempt_id: int):
     if not a["passed"]:
         abort(403)
 
+    return t, a
+
+
+def _certificate_status_body(slug, attempt_id: int, status: str) -> dict:
+    return {
+        "attempt_id": attempt_id,
+        "status": status,
+        "status_url": f"/tests/{slug}/certificate/{attempt_id}/status",
+        "download_url": f"/tests/{slug}/certificate/{attempt_id}",
+    }
+
+
+@app.get("/tests/<slug>/certificate/<int:attempt_id>")
+def certificate(slug, attempt_id: int):
+    t, a = _passed_attempt(slug, attempt_id)
+    filename = certificate_filename(a["student_name"], t["slug"])
+
+    if CERT_ASYNC:
+        key = certificate_key(a, t)
+        # Asking for the download explicitly retries a failed render
+        status = enqueue_certificate(key, a["student_name"], t["title"], retry=True)
+        if status == "ready":
+            return send_file(certificate_path(key), mimetype="application/pdf",
+                             as_attachment=True, download_name=filename)
+
+        body = _certificate_status_body(t["slug"], attempt_id, status)
+        if request.accept_mimetypes.best_match(["application/json", "text/html"]) == "text/html":
+            # Browser navigation (result page, admin PDF link, CSV url): show a polling page
+            return render_template("certificate_pending.html", test=t, job=body), 202
+        return jsonify(body), 202, {"Location": body["status_url"]}
+
     # Generate PDF
     date_str = datetime.now().strftime("%m/%d/%Y")
     pdf = make_certificate_pdf(a["student_name"], t["title"], date_str)
 
-    safe_name = re.sub(r"[^a-zA-Z0-9_-]+", "_", a["student_name"]).strip("_") or "student"
-    filename = f"Certificate_{safe_name}_{t['slug']}.pdf"
-
     return send_file(pdf, mimetype="application/pdf", as_attachment=True, download_name=filename)
 
 
+@app.get("/tests/<slug>/certificate/<int:attempt_id>/status")
+def certificate_status(slug, attempt_id: int):
+    t, a = _passed_attempt(slug, attempt_id)
+    if not CERT_ASYNC:
+        return jsonify(_certificate_status_body(t["slug"], attempt_id, "ready"))
+
+    key = certificate_key(a, t)
+    status = certificate_job_status(key)
+    if status is None:
+        status = enqueue_certificate(key, a["student_name"], t["title"])
+
+    return jsonify(_certificate_status_body(t["slug"], attempt_id, status))
+
+
 # -----------------------------
 # Admin routes (hidden)
 # -----------------------------
@@ -508,6 +856,17 @@ def controlpanel_results():
       </body>
     </html>
     """
+
+
+@app.get(f"{ADMIN_BASE}/certificate-jobs")
+def controlpanel_certificate_jobs():
+    if not is_admin():
+        return redirect(ADMIN_BASE)
+
+    # Queue depth and render latency for this worker process
+    return jsonify(certificate_metrics())
+
+
 @app.get(f"{ADMIN_BASE}/export.csv")
 def controlpanel_export_csv():
     if not is_admin():
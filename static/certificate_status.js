@@ -0,0 +1,41 @@
+// Polls a certificate job until the PDF is ready or the render fails.
+// Used by result.html and certificate_pending.html (CERT_ASYNC=1).
+function watchCertificate(opts) {
+  var POLL_MS = 1500;
+  var ERROR_POLL_MS = 3000;
+  var statusEl = opts.statusEl;
+  var retryEl = opts.retryEl;
+
+  function getJson(url) {
+    return fetch(url, { headers: { "Accept": "application/json" } })
+      .then(function (r) { return r.json(); });
+  }
+
+  function poll() {
+    getJson(opts.statusUrl)
+      .then(function (job) {
+        if (job.status === "ready") {
+          statusEl.textContent = "Your certificate is ready.";
+          opts.onReady(job);
+        } else if (job.status === "failed") {
+          statusEl.textContent = "Certificate could not be prepared.";
+          retryEl.style.display = "";
+        } else {
+          setTimeout(poll, POLL_MS);
+        }
+      })
+      .catch(function () { setTimeout(poll, ERROR_POLL_MS); });
+  }
+
+  retryEl.addEventListener("click", function (e) {
+    e.preventDefault();
+    retryEl.style.display = "none";
+    statusEl.textContent = "Preparing your certificate…";
+    // Asking the certificate route for JSON re-queues the failed render
+    getJson(opts.downloadUrl).then(poll, poll);
+  });
+
+  retryEl.style.display = "none";
+  statusEl.textContent = "Preparing your certificate…";
+  poll();
+}